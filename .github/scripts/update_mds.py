@@ -4,104 +4,253 @@
 This script is intended to be invoked from the GitHub Action workflow.
 """
 import argparse
+import base64
+import email.utils
+import hashlib
 import requests
-import jwt
 import json
+import logging
+import os
+import random
 import shutil
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timezone
 
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is used when unavailable
+    orjson = None
 
-def _http_get(url, *, timeout=30, headers=None, max_attempts=5):
-    """HTTP GET with small retry/backoff for transient failures (e.g. 429)."""
+# Top-level manifest of per-AAGUID input hashes. An AAGUID whose inputs hash
+# matches the previous run, and whose output files are all still present, is
+# skipped without rewriting anything. Delete the manifest to force every
+# AAGUID to be re-rendered.
+HASHES_FILENAME = '.aaguid_hashes.json'
+
+# Mixed into every input hash. Bump it whenever the per-AAGUID output format
+# or selection rules change, so the next run re-renders everything.
+HASHES_VERSION = 1
+
+# Fields that may carry the AAGUID in combined/c-MDS list entries, in order
+# of preference.
+AAGUID_FIELDS = ('aaguid', 'AAGUID', 'id', 'idHex')
+
+# friendlyNames locales preferred for display names, in order.
+_ENGLISH_LOCALES = ('en-US', 'en', 'en-GB')
+
+# Explicit canonical icon key list derived from repository analysis to avoid
+# false positives. Historically the repo uses the exact key "icon" in the
+# majority of metadata.json files.
+ICON_KEYS = frozenset(("icon",))
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Per-AAGUID work is dominated by small file syscalls, which release the GIL,
+# so oversubscribe the CPUs.
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Shared HTTP session so downloads reuse pooled connections instead of paying
+# a fresh TCP/TLS handshake per request (and per retry).
+_session = requests.Session()
+_session.headers.update({"User-Agent": "passkey-aaguids-update-script"})
+
+# Logging handlers are thread-safe, so worker threads can log directly.
+log = logging.getLogger("mds")
+
+
+def _json_loads(data):
+    """Parse JSON text or bytes with the stdlib parser.
+
+    orjson is not used for parsing: it silently turns integers outside the
+    64-bit range into floats, and the parsed MDS, combined and c-MDS data is
+    written back out to metadata.json and c_mds.json. The stdlib parser keeps
+    such integers exact.
+    """
+    if isinstance(data, bytes):
+        # Tolerate stray invalid UTF-8 in downloaded blobs.
+        data = data.decode('utf-8', errors='replace')
+    return json.loads(data)
+
+
+def _canonical_json(obj):
+    """Serialize to compact, key-sorted JSON bytes for hashing (not for output).
+
+    Uses orjson when installed. The bytes may differ from the stdlib rendering
+    (e.g. float formatting); that only matters for comparing hashes produced
+    in the same environment.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _dumps_indented(obj, sort_keys=False):
+    """Render ``obj`` as 2-space indented JSON bytes, using orjson when installed.
+
+    Only for documents made of strings and integers (summary, names list,
+    hash manifest), where orjson and stdlib json produce identical bytes.
+    metadata.json and c_mds.json stay on json.dumps because orjson formats
+    floats differently (2e-6 vs 2e-06).
+    """
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2, sort_keys=sort_keys).encode('utf-8')
+
+
+def _parse_retry_after(value):
+    """Return the delay in seconds from a Retry-After header (0 if absent/invalid).
+
+    Accepts both the delta-seconds and the HTTP-date forms.
+    """
+    if not value:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _backoff_seconds(attempt, retry_after=None):
+    """Delay before retrying after ``attempt``: jittered exponential backoff.
+
+    The +/-20% jitter keeps concurrent runs from retrying in lockstep. A
+    Retry-After header, when present, is honored as a lower bound.
+    """
+    wait_s = min(60, 2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+    return max(wait_s, _parse_retry_after(retry_after))
+
+
+def _http_get(url, *, timeout=30, headers=None, max_attempts=5, abandoned=None):
+    """HTTP GET with small retry/backoff for transient failures (e.g. 429).
+
+    ``abandoned`` is an optional threading.Event; once it is set, pending
+    retries are given up.
+    """
     last_exc = None
     for attempt in range(1, max_attempts + 1):
         try:
-            resp = requests.get(url, timeout=timeout, headers=headers)
-            if resp.status_code == 429:
-                retry_after = resp.headers.get("Retry-After")
-                try:
-                    wait_s = int(retry_after) if retry_after else 0
-                except Exception:
-                    wait_s = 0
-                # Fallback exponential backoff with a small floor.
-                wait_s = max(wait_s, min(60, 2 ** (attempt - 1)))
-                print(f"Received 429 for {url}; retrying in {wait_s}s (attempt {attempt}/{max_attempts})")
-                time.sleep(wait_s)
-                continue
-
-            resp.raise_for_status()
-            return resp
+            resp = _session.get(url, timeout=timeout, headers=headers)
+            if resp.status_code == 429 and attempt < max_attempts:
+                wait_s = _backoff_seconds(attempt, resp.headers.get("Retry-After"))
+                log.warning(f"Received 429 for {url}; retrying in {wait_s:.1f}s (attempt {attempt}/{max_attempts})")
+                last_exc = requests.HTTPError(f"429 Too Many Requests for url: {url}", response=resp)
+            else:
+                resp.raise_for_status()
+                return resp
         except Exception as e:
             last_exc = e
             if attempt >= max_attempts:
                 break
-            wait_s = min(60, 2 ** (attempt - 1))
-            print(f"Request failed for {url}: {e}; retrying in {wait_s}s (attempt {attempt}/{max_attempts})")
+            wait_s = _backoff_seconds(attempt)
+            log.warning(f"Request failed for {url}: {e}; retrying in {wait_s:.1f}s (attempt {attempt}/{max_attempts})")
+
+        if abandoned is None:
             time.sleep(wait_s)
+        elif abandoned.wait(wait_s):
+            break
 
     raise last_exc
 
 
-def download_mds():
-    """Download the FIDO MDS JWT blob"""
+def download_mds(abandoned=None):
+    """Download the FIDO MDS JWT blob as bytes"""
     url = "https://mds3.fidoalliance.org/"
-    print(f"Downloading MDS from {url}")
+    log.info(f"Downloading MDS from {url}")
 
-    response = _http_get(url, timeout=30)
-    return response.text
+    response = _http_get(url, timeout=30, abandoned=abandoned)
+    return response.content
 
 
-def download_combined_aaguid():
-    """Download the combined AAGUID JSON from the GitHub raw URL."""
+def download_combined_aaguid(abandoned=None):
+    """Download the combined AAGUID JSON (as bytes) from the GitHub raw URL."""
     url = "https://raw.githubusercontent.com/passkeydeveloper/passkey-authenticator-aaguids/refs/heads/main/combined_aaguid.json"
-    print(f"Downloading combined AAGUID JSON from {url}")
+    log.info(f"Downloading combined AAGUID JSON from {url}")
 
     try:
-        resp = _http_get(url, timeout=30)
-        return resp.text
+        resp = _http_get(url, timeout=30, abandoned=abandoned)
+        return resp.content
     except Exception as e:
-        print(f"Failed to download combined AAGUID JSON: {e}")
+        log.warning(f"Failed to download combined AAGUID JSON: {e}")
         return None
 
 
-def download_c_mds():
-    """Download the c-MDS AAGUID JSON blob.
+def download_c_mds(abandoned=None):
+    """Download the c-MDS AAGUID JSON blob as bytes.
 
     c-MDS currently serves JSON as application/octet-stream.
     """
     url = "https://c-mds.fidoalliance.org/"
-    print(f"Downloading c-MDS from {url}")
+    log.info(f"Downloading c-MDS from {url}")
 
     try:
         resp = _http_get(
             url,
-            headers={
-                "Accept": "application/json",
-                "User-Agent": "passkey-aaguids-update-script",
-            },
+            headers={"Accept": "application/json"},
+            abandoned=abandoned,
         )
-        # Content-Type may be application/octet-stream, so decode explicitly.
-        return resp.content.decode('utf-8', errors='replace')
+        # Content-Type may be application/octet-stream, so ignore any declared
+        # charset; the JSON parsers decode the raw bytes as UTF-8.
+        return resp.content
     except Exception as e:
-        print(f"Failed to download c-MDS JSON: {e}")
+        log.warning(f"Failed to download c-MDS JSON: {e}")
         return None
 
 
+def normalize_aaguid(aaguid):
+    """Return the lookup key for an AAGUID: lowercased with hyphens removed."""
+    return str(aaguid).lower().replace('-', '')
+
+
+def _aaguid_from_entry(entry):
+    """Return the first non-empty AAGUID-like field of an external entry."""
+    for field in AAGUID_FIELDS:
+        v = entry.get(field)
+        if v:
+            return v
+    return None
+
+
+def _canonical_aaguid(entry, key):
+    """Return the AAGUID to use for an external-only entry under normalized ``key``.
+
+    Prefers the entry's own AAGUID field; otherwise re-hyphenates a 32-digit key.
+    """
+    if isinstance(entry, dict):
+        v = _aaguid_from_entry(entry)
+        if v:
+            return str(v)
+    if len(key) == 32:
+        return f"{key[0:8]}-{key[8:12]}-{key[12:16]}-{key[16:20]}-{key[20:32]}"
+    return key
+
+
 def parse_combined_map(raw_text):
-    """Parse combined JSON text into a mapping keyed by normalized aaguid.
+    """Parse combined JSON text or bytes into a mapping keyed by normalized aaguid.
 
-    Normalization: lowercased string. Also add a version without hyphens to
-    improve matching against other AAGUID formats.
+    Normalization: lowercased string with hyphens removed, so hyphenated and
+    bare-hex AAGUIDs share a single key.
     """
     if not raw_text:
         return None
     try:
-        parsed = json.loads(raw_text)
+        parsed = _json_loads(raw_text)
     except Exception as e:
-        print(f"Could not parse combined JSON: {e}")
+        log.warning(f"Could not parse combined JSON: {e}")
         return None
 
     out = {}
@@ -109,11 +258,7 @@ def parse_combined_map(raw_text):
     def add_key(k, v):
         if not k:
             return
-        k1 = str(k).lower()
-        out[k1] = v
-        k2 = k1.replace('-', '')
-        if k2 != k1:
-            out[k2] = v
+        out[normalize_aaguid(k)] = v
 
     if isinstance(parsed, dict):
         # assume dict keyed by aaguid
@@ -123,8 +268,7 @@ def parse_combined_map(raw_text):
         for e in parsed:
             if not isinstance(e, dict):
                 continue
-            # try common fields
-            k = e.get('aaguid') or e.get('AAGUID') or e.get('id') or e.get('idHex')
+            k = _aaguid_from_entry(e)
             if k:
                 add_key(k, e)
     else:
@@ -141,28 +285,16 @@ def parse_c_mds_map(raw_text):
     return parse_combined_map(raw_text)
 
 
-def lookup_normalized(mapping, aaguid):
-    """Look up an AAGUID in a mapping with normalized keys.
-
-    Tries lowercased hyphenated and non-hyphenated forms.
-    """
-    if not mapping or not aaguid:
-        return None
-
-    a = str(aaguid).lower()
-    for k in (a, a.replace('-', '')):
-        if k in mapping:
-            return mapping[k]
-    return None
-
-
 def _normalize_single_line(text):
     if text is None:
         return None
     s = str(text)
+    # Fast path: printable text contains no whitespace other than ' ', so
+    # without double spaces there is nothing to collapse.
+    if s.isprintable() and '  ' not in s:
+        return s.strip()
     # Collapse all whitespace (including newlines/tabs) into single spaces.
-    s = re.sub(r"\s+", " ", s)
-    return s.strip()
+    return _WHITESPACE_RE.sub(" ", s).strip()
 
 
 def _format_for_log(text, max_len=140):
@@ -180,26 +312,33 @@ def _friendly_name_from_entry(entry):
     fn = entry.get('friendlyNames')
     if isinstance(fn, dict) and fn:
         # Prefer common English locales
-        for lang in ('en-US', 'en', 'en-GB'):
-            v = fn.get(lang)
-            if v:
-                return _normalize_single_line(v)
-        # Otherwise pick any value deterministically
-        for _, v in sorted(fn.items(), key=lambda kv: str(kv[0])):
-            if v:
-                return _normalize_single_line(v)
+        v = next((fn[lang] for lang in _ENGLISH_LOCALES if fn.get(lang)), None)
+        if v is not None:
+            return _normalize_single_line(v)
+        # Otherwise pick any value deterministically: the non-empty value
+        # with the smallest locale key.
+        first = min((kv for kv in fn.items() if kv[1]), key=lambda kv: str(kv[0]), default=None)
+        if first is not None:
+            return _normalize_single_line(first[1])
     # fallbacks
     v = entry.get('friendlyName') or entry.get('name')
     return _normalize_single_line(v) if v else None
 
 
 def parse_jwt(jwt_token):
-    """Parse JWT token without verification (MDS is publicly available)"""
+    """Parse JWT token without verification (MDS is publicly available)
+
+    Only the payload segment is needed, so decode it directly instead of going
+    through a JWT library.
+    """
     try:
-        decoded = jwt.decode(jwt_token, options={"verify_signature": False})
-        return decoded
+        if isinstance(jwt_token, str):
+            jwt_token = jwt_token.encode('ascii')
+        _, payload, _ = jwt_token.split(b'.', 2)
+        padding = b'=' * (-len(payload) % 4)
+        return _json_loads(base64.urlsafe_b64decode(payload + padding))
     except Exception as e:
-        print(f"Error decoding JWT: {e}")
+        log.warning(f"Error decoding JWT: {e}")
         return None
 
 
@@ -207,42 +346,45 @@ def extract_aaguids(mds_data):
     """Extract AAGUIDs and their metadata from MDS.
 
     Returns a mapping of aaguid -> list of metadata items. Multiple MDS entries
-    may refer to the same aaguid; preserve all of them.
+    may refer to the same aaguid; preserve all of them. ``mds_entry`` holds the
+    rest of the MDS entry (status reports, etc.); its metadataStatement is
+    stored once, under ``metadataStatement``, rather than duplicated.
     """
-    entries = mds_data.get('entries', [])
     aaguid_data = {}
+    setdefault = aaguid_data.setdefault
 
-    for entry in entries:
-        metadata_statement = entry.get('metadataStatement', {})
+    for entry in mds_data.get('entries', ()):
+        metadata_statement = entry.get('metadataStatement')
+        if not metadata_statement:
+            continue
         aaguid = metadata_statement.get('aaguid')
         if not aaguid:
             continue
 
         description = metadata_statement.get('description', 'Unknown')
-        name = description
-        if isinstance(description, dict):
+        if type(description) is dict:
             name = description.get('en', description.get('english', str(description)))
+        else:
+            name = description
 
-        item = {
+        setdefault(aaguid, []).append({
             'name': str(name),
             'description': description,
             'metadataStatement': metadata_statement,
-            'mds_entry': entry,
-        }
-
-        aaguid_data.setdefault(aaguid, []).append(item)
+            'mds_entry': {k: v for k, v in entry.items() if k != 'metadataStatement'},
+        })
 
     return aaguid_data
 
 
-def _choose_name_for_aaguid(aaguid, items, combined_map=None, c_mds_map=None):
-    """Choose the display name for an AAGUID using the current precedence rules."""
+def _choose_name_for_aaguid(items, combined_entry=None, c_mds_entry=None):
+    """Choose the display name for an AAGUID using the current precedence rules.
+
+    Takes the AAGUID's already-resolved combined and c-MDS entries.
+    """
     first = items[0] if items else {}
     new_name = first.get('name', 'Unknown')
 
-    combined_entry = lookup_normalized(combined_map, aaguid) if combined_map else None
-    c_mds_entry = lookup_normalized(c_mds_map, aaguid) if c_mds_map else None
-
     # Name precedence: combined primary, c-MDS fallback, then MDS.
     if isinstance(combined_entry, dict):
         ce_name = combined_entry.get('name')
@@ -260,311 +402,369 @@ def _choose_name_for_aaguid(aaguid, items, combined_map=None, c_mds_map=None):
     return _normalize_single_line(new_name) if new_name is not None else 'Unknown'
 
 
-def create_aaguid_directories(aaguid_data, base_path=Path('.'), dry_run=False, combined_map=None, c_mds_map=None):
-    """Create directories and files for each AAGUID under base_path"""
+def _coerce_icon(v):
+    """Normalize a metadataStatement icon value to the string written to icon.txt."""
+    # normalize value: if list -> first element; if dict -> compact JSON
+    if isinstance(v, list) and v:
+        val = v[0]
+    elif isinstance(v, dict):
+        try:
+            val = json.dumps(v, ensure_ascii=False, separators=(',', ':'))
+        except Exception:
+            val = str(v)
+    else:
+        val = v
+
+    # convert non-str values to string
+    if not isinstance(val, str):
+        try:
+            val = json.dumps(val, ensure_ascii=False)
+        except Exception:
+            val = str(val)
+    return val
+
+
+def _first_icon(items):
+    """Return the first MDS metadataStatement icon across items, or None."""
+    for item in items:
+        ms = item.get('metadataStatement', {}) or {}
+        for k, v in ms.items():
+            # Case-insensitive match; the exact-case check avoids lower()
+            # for the common spelling.
+            if k in ICON_KEYS or k.lower() in ICON_KEYS:
+                return _coerce_icon(v)
+    return None
+
+
+def _choose_icon(items, c_mds_entry):
+    """Return the icon.txt value: the c-MDS icon, else the first MDS icon, or None."""
+    if isinstance(c_mds_entry, dict):
+        ci = c_mds_entry.get('icon')
+        if ci:
+            return str(ci)
+    return _first_icon(items)
+
+
+def _expected_files(items, combined_entry, c_mds_entry):
+    """Return the names of the files _process_one writes for an AAGUID."""
+    expected = {'name.txt', 'metadata.json'}
+    if _choose_icon(items, c_mds_entry) is not None:
+        expected.add('icon.txt')
+    if isinstance(c_mds_entry, dict) and c_mds_entry:
+        expected.add('c_mds.json')
+    if combined_entry:
+        for field in ('icon_light', 'icon_dark'):
+            if combined_entry.get(field):
+                expected.add(f'{field}.txt')
+    return expected
+
+
+def _read_or_none(path):
+    """Return the contents of ``path`` as bytes, or None if it does not exist."""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _write_if_changed(path, data, dry_run=False):
+    """Write ``data`` (bytes) to ``path`` unless the file already holds it.
+
+    A size mismatch is detected from stat() alone; only same-size files are
+    read back for comparison. Writes go to a temporary file that is moved into
+    place with os.replace(), so a file is never left partially written.
+    Returns True when the content differs (and, unless dry_run, was written).
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+
+    if st is not None and st.st_size == len(data) and _read_or_none(path) == data:
+        return False
+
+    if not dry_run:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return True
+
+
+def _unlink_if_exists(path):
+    """Remove a stale output file. Returns True if a file was removed."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _inputs_hash(items, combined_entry, c_mds_entry):
+    """Return a short content hash of everything an AAGUID's files derive from."""
+    canonical = _canonical_json([HASHES_VERSION, items, combined_entry, c_mds_entry])
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+def _load_hashes(base_path):
+    """Load the per-AAGUID hash manifest, or an empty mapping if unavailable."""
+    raw = _read_or_none(base_path / HASHES_FILENAME)
+    if raw is None:
+        return {}
+    try:
+        hashes = _json_loads(raw)
+    except ValueError:
+        return {}
+    return hashes if isinstance(hashes, dict) else {}
+
+
+def _process_one(aaguid, items, combined_entry, c_mds_entry, name, base_dir, dry_run=False, old_hash=None, existed=False):
+    """Create or update the directory and files for a single AAGUID.
+
+    ``combined_entry`` and ``c_mds_entry`` are the AAGUID's entries from the
+    external maps (or None); ``name`` is its resolved display name.
+    ``old_hash`` is the inputs hash recorded by the previous run and
+    ``existed`` says whether the AAGUID directory is already present. An
+    existing directory whose inputs are unchanged and that still holds every
+    expected file is left untouched. Returns
+    ``(created, updated, inputs_hash)`` where the first two are 0/1 counters.
+    """
+    # Plain string paths: this runs for every AAGUID, and building pathlib
+    # objects for each child file is measurable overhead.
+    aaguid_dir = os.path.join(base_dir, aaguid)
+
+    inputs_hash = _inputs_hash(items, combined_entry, c_mds_entry)
+    if existed and inputs_hash == old_hash:
+        # One listing per AAGUID: re-render if any output was removed.
+        try:
+            present = set(os.listdir(aaguid_dir))
+        except FileNotFoundError:
+            present = set()
+        if _expected_files(items, combined_entry, c_mds_entry) <= present:
+            return 0, 1, inputs_hash
+    if not existed:
+        os.makedirs(aaguid_dir, exist_ok=True)
+
+    name_file = os.path.join(aaguid_dir, 'name.txt')
+
+    # Write only if changed
+    if _write_if_changed(name_file, name.encode('utf-8'), dry_run=dry_run) and dry_run:
+        old_name = _read_or_none(name_file)
+        if old_name is not None:
+            old_name = old_name.decode('utf-8', errors='replace')
+        old_preview = _format_for_log(old_name)
+        new_preview = _format_for_log(name)
+        log.info(
+            f"[dry-run] Would update {name_file} (len_old={len(old_name) if old_name else 0}, len_new={len(name)}): "
+            f"{old_preview!r} -> {new_preview!r}"
+        )
+
+    # Save full metadata list to metadata.json only if changed
+    metadata_file = os.path.join(aaguid_dir, 'metadata.json')
+    new_metadata = json.dumps(items, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8')
+    if _write_if_changed(metadata_file, new_metadata, dry_run=dry_run) and dry_run:
+        log.info(f"[dry-run] Would write {metadata_file} (size {len(new_metadata)} bytes)")
+
+    # Instead of producing icons.json, write only the first icon value
+    # encountered (if any) to a plain text file `icon.txt`.
+    icon_file = os.path.join(aaguid_dir, 'icon.txt')
+    # Icon precedence: c-MDS primary, then MDS metadataStatement icon.
+    first_icon_value = _choose_icon(items, c_mds_entry)
+
+    if first_icon_value is not None:
+        # Write only the raw icon value into icon.txt (no JSON wrapper)
+        if _write_if_changed(icon_file, first_icon_value.encode('utf-8'), dry_run=dry_run) and dry_run:
+            log.info(f"[dry-run] Would write {icon_file} (length={len(first_icon_value)})")
+    else:
+        # No icon found: remove stale icon.txt if present
+        if not dry_run and _unlink_if_exists(icon_file):
+            log.info(f"Removed stale {icon_file}")
+
+    # Write c_mds.json for this AAGUID when present
+    c_mds_file = os.path.join(aaguid_dir, 'c_mds.json')
+    if isinstance(c_mds_entry, dict) and c_mds_entry:
+        new_c_mds = json.dumps(c_mds_entry, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8')
+        if _write_if_changed(c_mds_file, new_c_mds, dry_run=dry_run) and dry_run:
+            log.info(f"[dry-run] Would write {c_mds_file} (size {len(new_c_mds)} bytes)")
+    else:
+        # No c-MDS entry: remove stale file
+        if not dry_run and _unlink_if_exists(c_mds_file):
+            log.info(f"Removed stale {c_mds_file}")
+
+    # Write icon_light.txt and icon_dark.txt from combined_entry if present
+    if combined_entry:
+        for field, filename in (('icon_light', 'icon_light.txt'), ('icon_dark', 'icon_dark.txt')):
+            value = combined_entry.get(field)
+            target = os.path.join(aaguid_dir, filename)
+            if value:
+                if _write_if_changed(target, value.encode('utf-8'), dry_run=dry_run) and dry_run:
+                    log.info(f"[dry-run] Would write {target} (length={len(value)})")
+            elif not dry_run and _unlink_if_exists(target):
+                log.info(f"Removed stale {target}")
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"Processed AAGUID: {aaguid} -> {_format_for_log(name)}")
+
+    return (0, 1, inputs_hash) if existed else (1, 0, inputs_hash)
+
+
+def create_aaguid_directories(aaguid_data, resolved, base_path=Path('.'), dry_run=False, max_workers=DEFAULT_WORKERS):
+    """Create directories and files for each AAGUID under base_path.
+
+    ``resolved`` maps each AAGUID to its ``(combined_entry, c_mds_entry, name)``
+    as resolved by the caller.
+
+    Each AAGUID writes only into its own directory, so the per-AAGUID work is
+    dispatched to a thread pool to keep many small file operations in flight.
+    """
     base_path = Path(base_path)
     base_path.mkdir(parents=True, exist_ok=True)
 
     created_count = 0
     updated_count = 0
+    old_hashes = _load_hashes(base_path)
+    new_hashes = {}
+    # One directory listing replaces a stat per AAGUID.
+    with os.scandir(base_path) as it:
+        existing = {entry.name for entry in it if entry.is_dir()}
+
+    # Workers get everything up front and only touch their own directory.
+    jobs = [(aaguid, items, *resolved[aaguid]) for aaguid, items in aaguid_data.items()]
+
+    base_dir = os.fspath(base_path)
+
+    def run(job):
+        aaguid = job[0]
+        return _process_one(
+            *job,
+            base_dir,
+            dry_run=dry_run,
+            old_hash=old_hashes.get(aaguid),
+            existed=aaguid in existing,
+        )
 
-    for aaguid, items in aaguid_data.items():
-        aaguid_dir = base_path / aaguid
-        if aaguid_dir.exists():
-            updated_count += 1
-        else:
-            created_count += 1
-
-        aaguid_dir.mkdir(exist_ok=True)
-
-        name_file = aaguid_dir / 'name.txt'
-        new_name = _choose_name_for_aaguid(aaguid, items, combined_map=combined_map, c_mds_map=c_mds_map)
-
-        # If extra sources provided, allow them to override/fill icon fields
-        combined_entry = lookup_normalized(combined_map, aaguid) if combined_map else None
-        c_mds_entry = lookup_normalized(c_mds_map, aaguid) if c_mds_map else None
-        # Write only if changed
-        if name_file.exists():
-            try:
-                old_name = name_file.read_text(encoding='utf-8')
-            except Exception:
-                old_name = None
-        else:
-            old_name = None
-
-        if old_name != new_name:
-            if dry_run:
-                old_preview = _format_for_log(old_name)
-                new_preview = _format_for_log(new_name)
-                print(
-                    f"[dry-run] Would update {name_file} (len_old={len(old_name) if old_name else 0}, len_new={len(new_name)}): "
-                    f"{old_preview!r} -> {new_preview!r}"
-                )
-            else:
-                name_file.write_text(new_name, encoding='utf-8')
-
-        # Save full metadata list to metadata.json only if changed
-        metadata_file = aaguid_dir / 'metadata.json'
-        new_metadata = json.dumps(items, ensure_ascii=False, indent=2, sort_keys=True)
-        if metadata_file.exists():
-            try:
-                old_metadata = metadata_file.read_text(encoding='utf-8')
-            except Exception:
-                old_metadata = None
-        else:
-            old_metadata = None
-
-        if old_metadata != new_metadata:
-            if dry_run:
-                print(f"[dry-run] Would write {metadata_file} (size {len(new_metadata)} bytes)")
-            else:
-                with open(metadata_file, 'w', encoding='utf-8') as mf:
-                    mf.write(new_metadata)
-
-        # Extract icon fields from metadataStatement(s) and write icons.json if any.
-        # Use an explicit canonical key list derived from repository analysis to
-        # avoid false positives. Historically the repo uses the exact key "icon"
-        # in the majority of metadata.json files.
-        icons = []
-        canonical_icon_keys = {"icon"}
-        for item in items:
-            ms = item.get('metadataStatement', {}) or {}
-            for k, v in ms.items():
-                # Case-insensitive match against the canonical key set
-                if str(k).lower() in canonical_icon_keys:
-                    # Normalize supported value shapes: string, list, or dict
-                    if isinstance(v, list):
-                        for elem in v:
-                            icons.append({'source_key': k, 'value': elem, 'name': item.get('name')})
-                    else:
-                        icons.append({'source_key': k, 'value': v, 'name': item.get('name')})
-
-        # Instead of producing icons.json, write only the first icon value
-        # encountered (if any) to a plain text file `icon.txt`.
-        icon_file = aaguid_dir / 'icon.txt'
-        # Icon precedence: c-MDS primary, then MDS metadataStatement icon.
-        first_icon_value = None
-        if isinstance(c_mds_entry, dict):
-            ci = c_mds_entry.get('icon')
-            if ci:
-                first_icon_value = str(ci)
-
-        if first_icon_value is None:
-            # canonical_icon_keys defined above; iterate again to find the first value
-            for item in items:
-                ms = item.get('metadataStatement', {}) or {}
-                for k, v in ms.items():
-                    if str(k).lower() in canonical_icon_keys:
-                        # normalize value: if list -> first element; if dict -> compact JSON
-                        if isinstance(v, list) and v:
-                            val = v[0]
-                        elif isinstance(v, dict):
-                            try:
-                                val = json.dumps(v, ensure_ascii=False, separators=(',', ':'))
-                            except Exception:
-                                val = str(v)
-                        else:
-                            val = v
-
-                        # convert non-str values to string
-                        if not isinstance(val, str):
-                            try:
-                                val = json.dumps(val, ensure_ascii=False)
-                            except Exception:
-                                val = str(val)
-
-                        first_icon_value = val
-                        break
-                if first_icon_value is not None:
-                    break
-
-        if first_icon_value is not None:
-            # Write only the raw icon value into icon.txt (no JSON wrapper)
-            if icon_file.exists():
-                try:
-                    old_icon = icon_file.read_text(encoding='utf-8')
-                except Exception:
-                    old_icon = None
-            else:
-                old_icon = None
-
-            if old_icon != first_icon_value:
-                if dry_run:
-                    print(f"[dry-run] Would write {icon_file} (length={len(first_icon_value)})")
-                else:
-                    with open(icon_file, 'w', encoding='utf-8') as f:
-                        f.write(first_icon_value)
-        else:
-            # No icon found: remove stale icon.txt if present
-            if icon_file.exists() and not dry_run:
-                try:
-                    icon_file.unlink()
-                    print(f"Removed stale {icon_file}")
-                except Exception:
-                    pass
-
-        # Write c_mds.json for this AAGUID when present
-        c_mds_file = aaguid_dir / 'c_mds.json'
-        if isinstance(c_mds_entry, dict) and c_mds_entry:
-            new_c_mds = json.dumps(c_mds_entry, ensure_ascii=False, indent=2, sort_keys=True)
-            if c_mds_file.exists():
-                try:
-                    old_c_mds = c_mds_file.read_text(encoding='utf-8')
-                except Exception:
-                    old_c_mds = None
-            else:
-                old_c_mds = None
-
-            if old_c_mds != new_c_mds:
-                if dry_run:
-                    print(f"[dry-run] Would write {c_mds_file} (size {len(new_c_mds)} bytes)")
-                else:
-                    c_mds_file.write_text(new_c_mds, encoding='utf-8')
-        else:
-            # No c-MDS entry: remove stale file
-            if c_mds_file.exists() and not dry_run:
-                try:
-                    c_mds_file.unlink()
-                    print(f"Removed stale {c_mds_file}")
-                except Exception:
-                    pass
-
-        # Write icon_light.txt and icon_dark.txt from combined_entry if present
-        if combined_entry:
-            # icon_light
-            il = combined_entry.get('icon_light')
-            light_file = aaguid_dir / 'icon_light.txt'
-            if il:
-                try:
-                    old = light_file.read_text(encoding='utf-8') if light_file.exists() else None
-                except Exception:
-                    old = None
-                if old != il:
-                    if dry_run:
-                        print(f"[dry-run] Would write {light_file} (length={len(il)})")
-                    else:
-                        with open(light_file, 'w', encoding='utf-8') as f:
-                            f.write(il)
-            else:
-                if light_file.exists() and not dry_run:
-                    try:
-                        light_file.unlink()
-                        print(f"Removed stale {light_file}")
-                    except Exception:
-                        pass
-
-            # icon_dark
-            idk = combined_entry.get('icon_dark')
-            dark_file = aaguid_dir / 'icon_dark.txt'
-            if idk:
-                try:
-                    oldd = dark_file.read_text(encoding='utf-8') if dark_file.exists() else None
-                except Exception:
-                    oldd = None
-                if oldd != idk:
-                    if dry_run:
-                        print(f"[dry-run] Would write {dark_file} (length={len(idk)})")
-                    else:
-                        with open(dark_file, 'w', encoding='utf-8') as f:
-                            f.write(idk)
-            else:
-                if dark_file.exists() and not dry_run:
-                    try:
-                        dark_file.unlink()
-                        print(f"Removed stale {dark_file}")
-                    except Exception:
-                        pass
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for job, (created, updated, inputs_hash) in zip(jobs, executor.map(run, jobs)):
+            created_count += created
+            updated_count += updated
+            new_hashes[job[0]] = inputs_hash
 
-    print(f"Processed AAGUID: {aaguid} -> {_format_for_log(new_name)}")
+    # Persist the manifest only when it changed; stale AAGUIDs drop out.
+    if new_hashes != old_hashes and not dry_run:
+        _write_if_changed(base_path / HASHES_FILENAME, _dumps_indented(new_hashes, sort_keys=True))
 
     return created_count, updated_count
 
 
-def main(dry_run=False, output_dir=None, sample_jwt=None):
+def main(dry_run=False, output_dir=None, sample_jwt=None, workers=DEFAULT_WORKERS):
+    # The downloads are independent, so start them together; the combined
+    # and c-MDS JSON keep downloading while the MDS JWT is parsed.
+    # Set when main stops waiting on them (e.g. after a failure), so pending
+    # retries give up instead of keeping the process alive.
+    abandoned = threading.Event()
+    downloader = ThreadPoolExecutor(max_workers=3)
     try:
+        combined_future = downloader.submit(download_combined_aaguid, abandoned)
+        c_mds_future = downloader.submit(download_c_mds, abandoned)
+        mds_future = None if sample_jwt else downloader.submit(download_mds, abandoned)
+
         if sample_jwt:
             # Read JWT from file
-            jwt_blob = Path(sample_jwt).read_text(encoding='utf-8')
-            print(f"Loaded sample JWT from {sample_jwt}")
+            jwt_blob = Path(sample_jwt).read_bytes()
+            log.info(f"Loaded sample JWT from {sample_jwt}")
         else:
-            jwt_blob = download_mds()
-            print("MDS downloaded successfully")
+            jwt_blob = mds_future.result()
+            # The future would otherwise keep the blob alive past the del below.
+            mds_future = None
+            log.info("MDS downloaded successfully")
 
         mds_data = parse_jwt(jwt_blob)
+        # Release the raw JWT text before building per-AAGUID data so the
+        # encoded and decoded payloads are not both held at peak.
+        del jwt_blob
         if not mds_data:
             raise Exception("Failed to parse MDS JWT")
 
-        print("MDS JWT parsed successfully")
+        log.info("MDS JWT parsed successfully")
 
         aaguid_data = extract_aaguids(mds_data)
-        print(f"Found {len(aaguid_data)} AAGUIDs in MDS")
+        del mds_data
+        log.info(f"Found {len(aaguid_data)} AAGUIDs in MDS")
 
         # Always download the combined AAGUID JSON from the canonical remote
         combined_map = None
-        raw_combined = download_combined_aaguid()
+        raw_combined = combined_future.result()
+        combined_future = None
         combined_map = parse_combined_map(raw_combined) if raw_combined else None
+        del raw_combined
         if combined_map is not None:
-            print(f"Loaded remote combined map with {len(combined_map)} entries")
+            log.info(f"Loaded remote combined map with {len(combined_map)} entries")
 
         # Download c-MDS map (3rd source)
         c_mds_map = None
-        raw_c_mds = download_c_mds()
+        raw_c_mds = c_mds_future.result()
+        c_mds_future = None
         c_mds_map = parse_c_mds_map(raw_c_mds) if raw_c_mds else None
+        del raw_c_mds
         if c_mds_map is not None:
-            print(f"Loaded c-MDS map with {len(c_mds_map)} entries")
+            log.info(f"Loaded c-MDS map with {len(c_mds_map)} entries")
 
         # Ensure we process the union of AAGUIDs present in MDS and the combined map.
-        # The combined map keys are normalized (lowercase, with and without hyphens).
+        # The combined map keys are normalized (lowercase, hyphens removed).
         # Normalize MDS aaguid keys the same way and merge-in any combined-only entries
         # so directories get created even if the AAGUID isn't present in MDS.
         if combined_map or c_mds_map:
-            # Build a set of normalized aaguid keys from MDS data
-            normalized_mds_keys = set()
-            for a in list(aaguid_data.keys()):
-                k = str(a).lower()
-                normalized_mds_keys.add(k)
-                normalized_mds_keys.add(k.replace('-', ''))
+            # Map normalized key -> AAGUID as used in aaguid_data. Placeholders
+            # are added to it too, so an AAGUID present in both external maps
+            # (in any spelling) gets a single directory.
+            known = {normalize_aaguid(a): a for a in aaguid_data}
 
             def ensure_placeholders(external_map, name_fn):
                 if not external_map:
                     return
-                for ck in list(external_map.keys()):
-                    if ck in normalized_mds_keys:
+                # Both key sets share one normalized form, so a set difference
+                # yields the external-only AAGUIDs directly. Sorted for a
+                # deterministic placeholder order.
+                for ck in sorted(external_map.keys() - known.keys()):
+                    entry = external_map[ck]
+                    canonical_aaguid = _canonical_aaguid(entry, ck)
+                    canonical_key = normalize_aaguid(canonical_aaguid)
+                    if canonical_key in known:
                         continue
-                    entry = external_map.get(ck)
-                    canonical_aaguid = None
-                    if isinstance(entry, dict):
-                        canonical_aaguid = entry.get('aaguid') or entry.get('AAGUID') or entry.get('id') or entry.get('idHex')
-                    if not canonical_aaguid:
-                        s = ck
-                        if len(s) == 32:
-                            canonical_aaguid = f"{s[0:8]}-{s[8:12]}-{s[12:16]}-{s[16:20]}-{s[20:32]}"
-                        else:
-                            canonical_aaguid = ck
-
-                    if canonical_aaguid not in aaguid_data:
-                        placeholder = {
-                            'name': _normalize_single_line(name_fn(entry)) or str(canonical_aaguid),
-                            'description': entry.get('description') if isinstance(entry, dict) else '',
-                            'metadataStatement': {},
-                            'mds_entry': {},
-                        }
-                        aaguid_data[canonical_aaguid] = [placeholder]
+                    placeholder = {
+                        'name': _normalize_single_line(name_fn(entry)) or str(canonical_aaguid),
+                        'description': entry.get('description') if isinstance(entry, dict) else '',
+                        'metadataStatement': {},
+                        'mds_entry': {},
+                    }
+                    aaguid_data[canonical_aaguid] = [placeholder]
+                    known[canonical_key] = known[ck] = canonical_aaguid
 
             # Ensure we create directories for entries that exist only in the external sources.
             ensure_placeholders(combined_map, lambda e: e.get('name') if isinstance(e, dict) else None)
             ensure_placeholders(c_mds_map, _friendly_name_from_entry)
 
+        # Resolve each AAGUID's external entries and display name once; used
+        # for the per-AAGUID directories and for aaguids.json.
+        resolved = {}
+        for aaguid, items in aaguid_data.items():
+            key = normalize_aaguid(aaguid)
+            combined_entry = combined_map.get(key) if combined_map else None
+            c_mds_entry = c_mds_map.get(key) if c_mds_map else None
+            name = _choose_name_for_aaguid(items, combined_entry, c_mds_entry)
+            resolved[aaguid] = (combined_entry, c_mds_entry, name)
+
         base_path = Path(output_dir) if output_dir else Path('.')
         created, updated = create_aaguid_directories(
             aaguid_data,
+            resolved,
             base_path=base_path,
             dry_run=dry_run,
-            combined_map=combined_map,
-            c_mds_map=c_mds_map,
+            max_workers=workers,
         )
-        print(f"Created {created} new AAGUID directories")
-        print(f"Updated {updated} existing AAGUID directories")
+        log.info(f"Created {created} new AAGUID directories")
+        log.info(f"Updated {updated} existing AAGUID directories")
 
         summary = {
             'total_aaguids': len(aaguid_data),
@@ -575,54 +775,42 @@ def main(dry_run=False, output_dir=None, sample_jwt=None):
 
         # Write summary only when changed
         summary_file = base_path / 'mds_summary.json'
-        new_summary = json.dumps(summary, ensure_ascii=False, indent=2, sort_keys=True)
-        if summary_file.exists():
-            try:
-                old_summary = summary_file.read_text(encoding='utf-8')
-            except Exception:
-                old_summary = None
-        else:
-            old_summary = None
-
-        if old_summary != new_summary:
-            if dry_run:
-                print(f"[dry-run] Would update {summary_file} (total_aaguids={summary['total_aaguids']})")
-            else:
-                summary_file.parent.mkdir(parents=True, exist_ok=True)
-                with open(summary_file, 'w', encoding='utf-8') as f:
-                    f.write(new_summary)
+        new_summary = _dumps_indented(summary, sort_keys=True)
+        if _write_if_changed(summary_file, new_summary, dry_run=dry_run) and dry_run:
+            log.info(f"[dry-run] Would update {summary_file} (total_aaguids={summary['total_aaguids']})")
 
         # Write a compact combined file containing only aaguid and name.
         # Uses the same name precedence rules as name.txt.
         names_file = base_path / 'aaguids.json'
         names_list = [
-            {
-                'aaguid': aaguid,
-                'name': _choose_name_for_aaguid(aaguid, items, combined_map=combined_map, c_mds_map=c_mds_map),
-            }
-            for aaguid, items in sorted(aaguid_data.items(), key=lambda kv: str(kv[0]).lower())
+            {'aaguid': aaguid, 'name': resolved[aaguid][2]}
+            for aaguid in sorted(aaguid_data, key=str.lower)
         ]
-        new_names = json.dumps(names_list, ensure_ascii=False, indent=2)
-        if names_file.exists():
-            try:
-                old_names = names_file.read_text(encoding='utf-8')
-            except Exception:
-                old_names = None
-        else:
-            old_names = None
-
-        if old_names != new_names:
-            if dry_run:
-                print(f"[dry-run] Would update {names_file} (total_aaguids={len(names_list)})")
-            else:
-                names_file.parent.mkdir(parents=True, exist_ok=True)
-                names_file.write_text(new_names, encoding='utf-8')
+        new_names = _dumps_indented(names_list)
+        if _write_if_changed(names_file, new_names, dry_run=dry_run) and dry_run:
+            log.info(f"[dry-run] Would update {names_file} (total_aaguids={len(names_list)})")
 
-        print("MDS update completed successfully")
+        log.info("MDS update completed successfully")
 
     except Exception as e:
-        print(f"Error: {e}")
+        log.error(f"Error: {e}")
         raise
+    finally:
+        # Every result has been consumed on success; on failure, drop queued
+        # downloads and cut short any retries still in progress.
+        abandoned.set()
+        downloader.shutdown(wait=False, cancel_futures=True)
+
+
+def _positive_int(value):
+    """argparse type for counts that must be at least 1."""
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {n}")
+    return n
 
 
 if __name__ == "__main__":
@@ -630,5 +818,8 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--dry-run', action='store_true', help='Show planned changes without writing files')
     parser.add_argument('-o', '--output-dir', help='Directory to write output files into (for testing)')
     parser.add_argument('-s', '--sample-jwt', help='Path to a sample JWT file to parse instead of downloading')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Also log every processed AAGUID')
+    parser.add_argument('-w', '--workers', type=_positive_int, default=DEFAULT_WORKERS, help='Number of AAGUID directories to write concurrently')
     args = parser.parse_args()
-    main(dry_run=args.dry_run, output_dir=args.output_dir, sample_jwt=args.sample_jwt)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+    main(dry_run=args.dry_run, output_dir=args.output_dir, sample_jwt=args.sample_jwt, workers=args.workers)